@@ -2,32 +2,60 @@
 #
 #
 
-import hashlib
 import hmac
 import logging
 import re
-from collections import defaultdict
-from time import gmtime, sleep, strftime
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from math import isfinite
+from operator import itemgetter
+from time import gmtime, sleep, time
 
 from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from octodns import __VERSION__ as octodns_version
 from octodns.provider import ProviderException
 from octodns.provider.base import BaseProvider
 from octodns.record import Record
 
+try:
+    # optional, faster json (de)serialization
+    import orjson as jsonlib
+except ImportError:
+    import json as jsonlib
+
+
 # TODO: remove __VERSION__ with the next major version release
 __version__ = __VERSION__ = '0.0.5'
 
 
+_name_and_type = itemgetter('name', 'type')
+
+
+def _txt_value_repl(match):
+    return '\\;' if match.group(0) == ';' else ''
+
+
 class DnsMadeEasyClientException(ProviderException):
     pass
 
 
 class DnsMadeEasyClientBadRequest(DnsMadeEasyClientException):
     def __init__(self, resp):
-        errors = '\n  - '.join(resp.json()['error'])
-        super().__init__(f'\n  - {errors}')
+        try:
+            body = jsonlib.loads(resp.content)
+        except ValueError:
+            body = None
+        errors = body.get('error') if isinstance(body, dict) else None
+        if not errors:
+            # not the usual error format, fall back to the raw body
+            errors = (resp.text,)
+        elif not isinstance(errors, list):
+            # a single error rather than the usual list of them
+            errors = (errors,)
+        super().__init__('\n  - ' + '\n  - '.join(str(e) for e in errors))
 
 
 class DnsMadeEasyClientUnauthorized(DnsMadeEasyClientException):
@@ -43,6 +71,34 @@ class DnsMadeEasyClientNotFound(DnsMadeEasyClientException):
 class DnsMadeEasyClient(object):
     PRODUCTION = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
     SANDBOX = 'https://api.sandbox.dnsmadeeasy.com/V2.0/dns/managed'
+    # types whose values DNS Made Easy may return relative to the zone
+    RELATIVE_VALUE_TYPES = frozenset(('ALIAS', 'CNAME', 'MX', 'NS', 'SRV'))
+    PAGE_SIZE = 500
+    # transient failures & rate limiting, retried with backoff
+    RETRY_STATUSES = frozenset((429, 502, 503, 504))
+    # creates aren't idempotent, a 5xx may have been applied, but a 429 means
+    # the request was rejected without being processed
+    RETRY_POST_STATUSES = frozenset((429,))
+    RETRIES = 5
+    RETRY_BACKOFF = 0.25
+    # cap on how long we'll wait when told to via Retry-After
+    RETRY_AFTER_MAX = 60
+    # RFC 1123 names, strftime's %a & %b are locale dependent
+    WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+    MONTHS = (
+        'Jan',
+        'Feb',
+        'Mar',
+        'Apr',
+        'May',
+        'Jun',
+        'Jul',
+        'Aug',
+        'Sep',
+        'Oct',
+        'Nov',
+        'Dec',
+    )
 
     def __init__(
         self,
@@ -51,13 +107,43 @@ class DnsMadeEasyClient(object):
         sandbox=False,
         ratelimit_delay=0.0,
         batch_size=200,
+        delete_batch_size=None,
+        concurrent_batches=1,
     ):
         self.api_key = api_key
         self.secret_key = secret_key
         self._base = self.SANDBOX if sandbox else self.PRODUCTION
         self.ratelimit_delay = ratelimit_delay
         self.batch_size = batch_size
+        # deletes only send ids so they can be batched independently of creates
+        self.delete_batch_size = delete_batch_size or batch_size
+        self.concurrent_batches = concurrent_batches
+        # encode once, the key is used to sign every request
+        self._secret_key = secret_key.encode()
         self._sess = Session()
+        # let urllib3 retry connection failures. these resend the already
+        # signed headers so the total wait is kept to a couple of seconds.
+        # retries based on status, which may wait much longer, are left
+        # entirely to _request where each attempt is signed afresh, urllib3
+        # would otherwise still retry statuses that come with Retry-After. POST
+        # is left out of the retryable methods as creates aren't idempotent
+        retry = Retry(
+            total=3,
+            backoff_factor=0.25,
+            status=0,
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        # enough pooled connections for every request that can be in flight at
+        # once
+        self._sess.mount(
+            'https://',
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=max(concurrent_batches, 1),
+                max_retries=retry,
+            ),
+        )
         self._sess.headers.update(
             {
                 'x-dnsme-apiKey': self.api_key,
@@ -65,25 +151,57 @@ class DnsMadeEasyClient(object):
             }
         )
         self._domains = None
+        self._now = None
+        self._now_str = None
 
     def _current_time(self):
-        return strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+        # only second resolution is needed, reuse the formatted value for
+        # requests made within the same second
+        now = int(time())
+        if now != self._now:
+            tm = gmtime(now)
+            self._now_str = (
+                f'{self.WEEKDAYS[tm.tm_wday]}, {tm.tm_mday:02d} '
+                f'{self.MONTHS[tm.tm_mon - 1]} {tm.tm_year} '
+                f'{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d} +0000'
+            )
+            self._now = now
+        return self._now_str
 
     def _hmac_hash(self, now):
-        return hmac.new(
-            self.secret_key.encode(), now.encode(), hashlib.sha1
-        ).hexdigest()
+        # hmac.digest is a one-shot that goes straight to OpenSSL
+        return hmac.digest(self._secret_key, now.encode(), 'sha1').hex()
 
     def _request(self, method, path, params=None, data=None):
-        now = self._current_time()
-        hmac_hash = self._hmac_hash(now)
-
-        headers = {'x-dnsme-hmac': hmac_hash, 'x-dnsme-requestDate': now}
+        headers = {}
+        if data is not None:
+            # serialize ourselves so that orjson is used when available
+            data = jsonlib.dumps(data)
+            headers['Content-Type'] = 'application/json'
 
         url = f'{self._base}{path}'
-        resp = self._sess.request(
-            method, url, headers=headers, params=params, json=data
+        retry_statuses = (
+            self.RETRY_POST_STATUSES
+            if method == 'POST'
+            else self.RETRY_STATUSES
         )
+        attempt = 0
+        while True:
+            # (re)sign each attempt, the request date has to be current
+            now = self._current_time()
+            headers['x-dnsme-hmac'] = self._hmac_hash(now)
+            headers['x-dnsme-requestDate'] = now
+            resp = self._sess.request(
+                method, url, headers=headers, params=params, data=data
+            )
+            if (
+                resp.status_code not in retry_statuses
+                or attempt >= self.RETRIES
+            ):
+                break
+            attempt += 1
+            sleep(self._retry_wait(resp, attempt))
+
         if resp.status_code == 400:
             raise DnsMadeEasyClientBadRequest(resp)
         if resp.status_code in [401, 403]:
@@ -91,28 +209,53 @@ class DnsMadeEasyClient(object):
         if resp.status_code == 404:
             raise DnsMadeEasyClientNotFound()
         resp.raise_for_status()
-        sleep(self.ratelimit_delay)
+        if self.ratelimit_delay:
+            sleep(self.ratelimit_delay)
         return resp
 
+    def _retry_wait(self, resp, attempt):
+        try:
+            # honor Retry-After when it's given in seconds, within reason
+            wait = float(resp.headers['Retry-After'])
+        except (KeyError, ValueError):
+            wait = None
+        if wait is None or not isfinite(wait):
+            return self.RETRY_BACKOFF * 2 ** (attempt - 1)
+        return min(max(wait, 0), self.RETRY_AFTER_MAX)
+
+    def _json(self, resp):
+        return jsonlib.loads(resp.content)
+
+    def _page(self, path, page):
+        params = {'rows': self.PAGE_SIZE, 'page': page}
+        return self._json(self._request('GET', path, params=params))
+
+    def _paginated(self, path):
+        resp = self._page(path, 0)
+        ret = resp['data']
+        total_pages = resp.get('totalPages', 1)
+        if total_pages > 1:
+            # we know how many pages there are now, fetch the rest
+            for resp in self._map(
+                lambda page: self._page(path, page), range(1, total_pages)
+            ):
+                ret.extend(resp['data'])
+        return ret
+
     @property
     def domains(self):
         if self._domains is None:
-            zones = []
-
-            # has pages in resp, do we need paging?
-            resp = self._request('GET', '/').json()
-            zones += resp['data']
-
+            zones = self._paginated('/')
             self._domains = {f'{z["name"]}.': z['id'] for z in zones}
 
         return self._domains
 
     def domain(self, name):
         path = f'/id/{name}'
-        return self._request('GET', path).json()
+        return self._json(self._request('GET', path))
 
     def domain_create(self, name):
-        response = self._request('POST', '/', data={'name': name}).json()
+        response = self._json(self._request('POST', '/', data={'name': name}))
         # Add our newly created domain to the cache
         self.domains[f'{name}.'] = response['id']
 
@@ -120,24 +263,21 @@ class DnsMadeEasyClient(object):
         zone_id = self.domains.get(zone_name, False)
         if not zone_id:
             return []
-        path = f'/{zone_id}/records'
-        ret = []
-
-        # has pages in resp, do we need paging?
-        resp = self._request('GET', path).json()
-        ret += resp['data']
+        ret = self._paginated(f'/{zone_id}/records')
 
+        relative_types = self.RELATIVE_VALUE_TYPES
         for record in ret:
+            _type = record['type']
             # change ANAME records to ALIAS
-            if record['type'] == 'ANAME':
-                record['type'] = 'ALIAS'
+            if _type == 'ANAME':
+                _type = record['type'] = 'ALIAS'
 
             # change relative values to absolute
-            value = record['value']
-            if record['type'] in ['ALIAS', 'CNAME', 'MX', 'NS', 'SRV']:
-                if value == '':
+            if _type in relative_types:
+                value = record['value']
+                if not value:
                     record['value'] = zone_name
-                elif not value.endswith('.'):
+                elif value[-1] != '.':
                     record['value'] = f'{value}.{zone_name}'
 
         return ret
@@ -147,8 +287,16 @@ class DnsMadeEasyClient(object):
         path = f'/{zone_id}/records'
 
         # there is a maximum batch size for bulk actions, batch the records based on our batch size
-        for batch in self._batch_records(record_ids):
-            self._request('DELETE', path, params={'ids': batch})
+        self._batch_requests(
+            'DELETE',
+            path,
+            (
+                {'params': {'ids': batch}}
+                for batch in self._batch_records(
+                    record_ids, self.delete_batch_size
+                )
+            ),
+        )
 
     def record_multi_create(self, zone_name, records):
         zone_id = self.domains.get(zone_name, False)
@@ -161,12 +309,41 @@ class DnsMadeEasyClient(object):
             record['gtdLocation'] = 'DEFAULT'
 
         # there is a maximum batch size for bulk actions, batch the records based on our batch size
-        for batch in self._batch_records(records):
-            self._request('POST', path, data=batch)
+        self._batch_requests(
+            'POST',
+            path,
+            (
+                {'data': batch}
+                for batch in self._batch_records(records, self.batch_size)
+            ),
+        )
 
-    def _batch_records(self, records):
-        for i in range(0, len(records), self.batch_size):
-            yield records[i : i + self.batch_size]
+    def _batch_requests(self, method, path, batches):
+        # consume the results so that any exceptions are raised
+        list(
+            self._map(
+                lambda kwargs: self._request(method, path, **kwargs), batches
+            )
+        )
+
+    def _map(self, func, items):
+        if self.concurrent_batches > 1:
+            # keep several requests in flight at once over the session's pool
+            with ThreadPoolExecutor(
+                max_workers=self.concurrent_batches
+            ) as executor:
+                yield from executor.map(func, items)
+        else:
+            yield from map(func, items)
+
+    def _batch_records(self, records, batch_size):
+        # works with any iterable, batches are only materialized as they're
+        # needed
+        it = iter(records)
+        batch = list(islice(it, batch_size))
+        while batch:
+            yield batch
+            batch = list(islice(it, batch_size))
 
 
 class DnsMadeEasyProvider(BaseProvider):
@@ -194,6 +371,13 @@ class DnsMadeEasyProvider(BaseProvider):
     #  Will match: Alpha""Bravo
     #  Will not match: Alpha\""Bravo
     TXT_RECORD_VALUE_DELIMITER_PATTERN = re.compile(r'(?<!\\)\"\"')
+    # Single pass that both escapes semicolons and removes the delimiters
+    # matched by TXT_RECORD_VALUE_DELIMITER_PATTERN. Since the escaping only ever
+    # inserts a backslash before a ; the lookbehind sees the same thing it would
+    # have after a separate replace.
+    TXT_RECORD_VALUE_PATTERN = re.compile(
+        f';|{TXT_RECORD_VALUE_DELIMITER_PATTERN.pattern}'
+    )
 
     def __init__(
         self,
@@ -203,22 +387,46 @@ class DnsMadeEasyProvider(BaseProvider):
         sandbox=False,
         ratelimit_delay=0.0,
         batch_size=200,
+        delete_batch_size=None,
+        concurrent_batches=1,
         *args,
         **kwargs,
     ):
         self.log = logging.getLogger(f'DnsMadeEasyProvider[{id}]')
         self.log.debug(
-            '__init__: id=%s, api_key=***, secret_key=***, sandbox=%s, batch_size=%s',
+            '__init__: id=%s, api_key=***, secret_key=***, sandbox=%s, batch_size=%s, delete_batch_size=%s, concurrent_batches=%s',
             id,
             sandbox,
             batch_size,
+            delete_batch_size,
+            concurrent_batches,
         )
         super().__init__(id, *args, **kwargs)
         self._client = DnsMadeEasyClient(
-            api_key, secret_key, sandbox, ratelimit_delay, batch_size
+            api_key,
+            secret_key,
+            sandbox,
+            ratelimit_delay,
+            batch_size,
+            delete_batch_size,
+            concurrent_batches,
         )
 
         self._zone_records = {}
+        self._zone_record_ids = {}
+        self._data_for = {
+            _type: getattr(self, f'_data_for_{_type}')
+            for _type in self.SUPPORTS
+        }
+        self._params_for = {
+            _type: getattr(self, f'_params_for_{_type}')
+            for _type in self.SUPPORTS
+        }
+        self._mod = {
+            'Create': self._mod_Create,
+            'Delete': self._mod_Delete,
+            'Update': self._mod_Update,
+        }
 
     def _data_for_multiple(self, _type, records):
         return {
@@ -245,12 +453,8 @@ class DnsMadeEasyProvider(BaseProvider):
 
     def _data_for_TXT(self, _type, records):
         # Long TXT records in DNS Mady Easy have their value split into 255 character chunks, delimited by "".
-        values = [
-            self.TXT_RECORD_VALUE_DELIMITER_PATTERN.sub(
-                '', value['value'].replace(';', '\\;')
-            )
-            for value in records
-        ]
+        sub = self.TXT_RECORD_VALUE_PATTERN.sub
+        values = [sub(_txt_value_repl, value['value']) for value in records]
         return {'ttl': records[0]['ttl'], 'type': _type, 'values': values}
 
     _data_for_SPF = _data_for_TXT
@@ -290,6 +494,15 @@ class DnsMadeEasyProvider(BaseProvider):
 
         return self._zone_records[zone.name]
 
+    def zone_record_ids(self, zone):
+        if zone.name not in self._zone_record_ids:
+            ids = {}
+            for record in self.zone_records(zone):
+                ids.setdefault(_name_and_type(record), []).append(record['id'])
+            self._zone_record_ids[zone.name] = ids
+
+        return self._zone_record_ids[zone.name]
+
     def populate(self, zone, target=False, lenient=False):
         self.log.debug(
             'populate: name=%s, target=%s, lenient=%s',
@@ -298,28 +511,27 @@ class DnsMadeEasyProvider(BaseProvider):
             lenient,
         )
 
-        values = defaultdict(lambda: defaultdict(list))
+        values = {}
         for record in self.zone_records(zone):
-            _type = record['type']
-            if _type not in self.SUPPORTS:
+            key = _name_and_type(record)
+            if key[1] not in self.SUPPORTS:
                 self.log.warning(
-                    'populate: skipping unsupported %s record', _type
+                    'populate: skipping unsupported %s record', key[1]
                 )
                 continue
-            values[record['name']][record['type']].append(record)
+            values.setdefault(key, []).append(record)
 
         before = len(zone.records)
-        for name, types in values.items():
-            for _type, records in types.items():
-                data_for = getattr(self, f'_data_for_{_type}')
-                record = Record.new(
-                    zone,
-                    name,
-                    data_for(_type, records),
-                    source=self,
-                    lenient=lenient,
-                )
-                zone.add_record(record, lenient=lenient)
+        data_for = self._data_for
+        for (name, _type), records in values.items():
+            record = Record.new(
+                zone,
+                name,
+                data_for[_type](_type, records),
+                source=self,
+                lenient=lenient,
+            )
+            zone.add_record(record, lenient=lenient)
 
         exists = zone.name in self._zone_records
         self.log.info(
@@ -356,7 +568,8 @@ class DnsMadeEasyProvider(BaseProvider):
 
     def _process_desired_zone(self, desired):
         for record in desired.records:
-            if record._type == 'TXT' and any('"' in v for v in record.values):
+            # a single scan of the joined values rather than one per value
+            if record._type == 'TXT' and '"' in ''.join(record.values):
                 msg = 'Quotes not supported in TXT values'
                 fallback = 'removing them'
                 self.supports_warn_or_except(msg, fallback)
@@ -367,13 +580,15 @@ class DnsMadeEasyProvider(BaseProvider):
         return desired
 
     def _params_for_multiple(self, record):
-        for value in record.values:
-            yield {
+        return [
+            {
                 'value': value,
                 'name': record.name,
                 'ttl': record.ttl,
                 'type': record._type,
             }
+            for value in record.values
+        ]
 
     _params_for_A = _params_for_multiple
     _params_for_AAAA = _params_for_multiple
@@ -384,30 +599,34 @@ class DnsMadeEasyProvider(BaseProvider):
     _params_for_NS = _params_for_multiple
 
     def _params_for_single(self, record):
-        yield {
-            'value': record.value,
-            'name': record.name,
-            'ttl': record.ttl,
-            'type': record._type,
-        }
+        return [
+            {
+                'value': record.value,
+                'name': record.name,
+                'ttl': record.ttl,
+                'type': record._type,
+            }
+        ]
 
     _params_for_CNAME = _params_for_single
     _params_for_PTR = _params_for_single
     _params_for_ALIAS = _params_for_single
 
     def _params_for_MX(self, record):
-        for value in record.values:
-            yield {
+        return [
+            {
                 'value': value.exchange,
                 'name': record.name,
                 'mxLevel': value.preference,
                 'ttl': record.ttl,
                 'type': record._type,
             }
+            for value in record.values
+        ]
 
     def _params_for_SRV(self, record):
-        for value in record.values:
-            yield {
+        return [
+            {
                 'value': value.target,
                 'name': record.name,
                 'port': value.port,
@@ -416,24 +635,28 @@ class DnsMadeEasyProvider(BaseProvider):
                 'type': record._type,
                 'weight': value.weight,
             }
+            for value in record.values
+        ]
 
     def _params_for_TXT(self, record):
         # DNSMadeEasy doesn't need chunking, it accepts the record and will chunk it itself
         # DNSMadeEasy does not want values escaped
-        for value in record.values:
-            value = value.replace('\\;', ';')
-            yield {
+        values = [value.replace('\\;', ';') for value in record.values]
+        return [
+            {
                 'value': f'"{value}"',
                 'name': record.name,
                 'ttl': record.ttl,
                 'type': record._type,
             }
+            for value in values
+        ]
 
     _params_for_SPF = _params_for_TXT
 
     def _params_for_CAA(self, record):
-        for value in record.values:
-            yield {
+        return [
+            {
                 'value': value.value,
                 'issuerCritical': value.flags,
                 'name': record.name,
@@ -441,31 +664,31 @@ class DnsMadeEasyProvider(BaseProvider):
                 'ttl': record.ttl,
                 'type': record._type,
             }
+            for value in record.values
+        ]
 
     def _mod_Create(self, change):
-        creations = []
         new = change.new
-        params_for = getattr(self, f'_params_for_{new._type}')
-        for params in params_for(new):
-            creations.append(params)
-        return new.zone, [], creations
+        return new.zone, [], self._params_for[new._type](new)
+
+    def _existing_ids(self, existing):
+        ids = self.zone_record_ids(existing.zone).get(
+            (existing.name, existing._type)
+        )
+        # copy, the caller may extend what we return
+        return list(ids) if ids else []
 
     def _mod_Delete(self, change):
-        deletions = []
         existing = change.existing
-        zone = existing.zone
-        for record in self.zone_records(zone):
-            if (
-                existing.name == record['name']
-                and existing._type == record['type']
-            ):
-                deletions.append(record['id'])
-        return zone, deletions, []
+        return existing.zone, self._existing_ids(existing), []
 
     def _mod_Update(self, change):
-        _, deletions, _ = self._mod_Delete(change)
-        zone, _, creations = self._mod_Create(change)
-        return zone, deletions, creations
+        new = change.new
+        return (
+            new.zone,
+            self._existing_ids(change.existing),
+            self._params_for[new._type](new),
+        )
 
     def _apply(self, plan):
         desired = plan.desired
@@ -486,18 +709,17 @@ class DnsMadeEasyProvider(BaseProvider):
         # Optimise our changes into a single set of creates/delete operations for each zone
         for change in changes:
             class_name = change.__class__.__name__
-            zone, mod_del, mod_create = getattr(self, f'_mod_{class_name}')(
-                change
-            )
-            if zone.name in zone_operations:
-                zone_operations[zone.name]['deletions'].extend(mod_del)
-                zone_operations[zone.name]['creations'].extend(mod_create)
-            else:
+            zone, mod_del, mod_create = self._mod[class_name](change)
+            operation = zone_operations.get(zone.name)
+            if operation is None:
                 zone_operations[zone.name] = {
                     'zone': zone,
                     'deletions': mod_del,
                     'creations': mod_create,
                 }
+            else:
+                operation['deletions'].extend(mod_del)
+                operation['creations'].extend(mod_create)
 
         # Perform our operations
         for zone_name, operation in zone_operations.items():
@@ -512,3 +734,4 @@ class DnsMadeEasyProvider(BaseProvider):
 
         # Clear out the cache if any
         self._zone_records.pop(desired.name, None)
+        self._zone_record_ids.pop(desired.name, None)
@@ -36,10 +36,15 @@ setup(
             'black>=24.3.0,<25.0.0',
             'build>=0.7.0',
             'isort>=5.11.5',
+            # the optional json backend, so that its path is tested
+            'orjson>=3.8.0',
             'pyflakes>=2.2.0',
             'readme_renderer[md]>=26.0',
             'twine>=3.4.2',
         ),
+        # optional, faster json (de)serialization, 3.8.0 is the oldest release
+        # verified to serialize octodns' str subclass values
+        'orjson': ('orjson>=3.8.0',),
         'test': tests_require,
     },
     install_requires=('octodns>=0.9.14', 'requests>=2.27.0'),
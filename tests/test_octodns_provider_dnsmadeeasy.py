@@ -2,158 +2,437 @@
 #
 #
 
+import hashlib
+import hmac
 import json
+from functools import lru_cache
+from importlib.util import module_from_spec, spec_from_file_location
+from os import listdir
 from os.path import dirname, join
-from unittest import TestCase
-from unittest.mock import Mock, call
+from unittest import TestCase, skipUnless
+from unittest.mock import Mock, call, patch
 
 from requests import HTTPError
-from requests_mock import ANY
-from requests_mock import mock as requests_mock
+from requests_mock import ANY, Adapter
 
 from octodns.provider import SupportsException
 from octodns.provider.yaml import YamlProvider
 from octodns.record import Record
 from octodns.zone import Zone
 
-from octodns_dnsmadeeasy import DnsMadeEasyClientNotFound, DnsMadeEasyProvider
-
-
-class TestDnsMadeEasyProvider(TestCase):
-    expected = Zone('unit.tests.', [])
-    source = YamlProvider('test', join(dirname(__file__), 'config'))
-    source.populate(expected)
-
-    # Our test suite differs a bit, add our NS and remove the simple one
-    expected.add_record(
-        Record.new(
-            expected,
-            'under',
-            {
-                'ttl': 3600,
-                'type': 'NS',
-                'values': ['ns1.unit.tests.', 'ns2.unit.tests.'],
-            },
-        )
+import octodns_dnsmadeeasy
+from octodns_dnsmadeeasy import (
+    DnsMadeEasyClientBadRequest,
+    DnsMadeEasyClientNotFound,
+    DnsMadeEasyProvider,
+)
+
+try:
+    # optional extra, installed as part of dev
+    import orjson
+except ImportError:  # e.g. running against an installed wheel
+    orjson = None
+
+
+def _load_fixtures():
+    fixtures = join(dirname(__file__), 'fixtures')
+    ret = {}
+    for name in sorted(listdir(fixtures)):
+        with open(join(fixtures, name), 'rb') as fh:
+            ret[name] = fh.read()
+    return ret
+
+
+# read and parsed once at import. raw bytes so that requests_mock can serve
+# them via content= as-is, the parsed versions are shared so treat them as
+# read-only
+FIXTURE_BYTES = _load_fixtures()
+FIXTURE_JSON = {name: json.loads(raw) for name, raw in FIXTURE_BYTES.items()}
+
+
+# the parsed responses, in order, while applying the expected zone to an
+# account that doesn't have the domain yet
+CREATE_RESPONSES = (
+    FIXTURE_JSON['dnsmadeeasy-no-domains.json'],  # no zone in populate
+    DnsMadeEasyClientNotFound(),  # no domain during apply
+    FIXTURE_JSON['dnsmadeeasy-domain-create.json'],  # our created domain
+    FIXTURE_JSON['dnsmadeeasy-domains.json'],
+)
+
+
+# what the account already has, as returned by the client's records(). the
+# provider only reads these so a shared tuple is fine
+ACCOUNT_RECORDS = (
+    {
+        'id': 11189897,
+        'name': 'www',
+        'value': '1.2.3.4',
+        'ttl': 300,
+        'type': 'A',
+    },
+    {
+        'id': 11189898,
+        'name': 'www',
+        'value': '2.2.3.4',
+        'ttl': 300,
+        'type': 'A',
+    },
+    {
+        'id': 11189899,
+        'name': 'ttl',
+        'value': '3.2.3.4',
+        'ttl': 600,
+        'type': 'A',
+    },
+)
+
+
+@lru_cache(maxsize=None)
+def ttl_zone():
+    # just the ttl A record, with a different ttl than the one in the account
+    wanted = Zone('unit.tests.', [])
+    wanted.add_record(
+        Record.new(wanted, 'ttl', {'ttl': 300, 'type': 'A', 'value': '3.2.3.4'})
     )
+    return wanted
+
 
-    # Add some ALIAS records
-    expected.add_record(
-        Record.new(
-            expected,
-            '',
-            {'ttl': 1800, 'type': 'ALIAS', 'value': 'aname.unit.tests.'},
+@lru_cache(maxsize=None)
+def www_zone():
+    # www1-9 A records, enough to span several batches
+    wanted = Zone('unit.tests.', [])
+    for i in range(1, 10):
+        wanted.add_record(
+            Record.new(
+                wanted,
+                f'www{i}',
+                {'ttl': 300, 'type': 'A', 'value': f'3.2.3.{i}'},
+            )
         )
+    return wanted
+
+
+def _rec(name, _type, value, ttl, **extra):
+    # the params we expect to be sent to createMulti for a record
+    return {
+        'value': value,
+        'name': name,
+        'ttl': ttl,
+        'type': _type,
+        'gtdLocation': 'DEFAULT',
+        **extra,
+    }
+
+
+# the requests made when applying the expected zone to an account that doesn't
+# have the domain yet, in order
+EXPECTED_CREATE_CALLS = (
+    # get all domains to build the cache
+    call('GET', '/', params={'rows': 500, 'page': 0}),
+    # attempt to find the domain based on the name
+    call('GET', '/id/unit.tests'),
+    # create the domain
+    call('POST', '/', data={'name': 'unit.tests'}),
+    # created all the non-existent records in a single request
+    call(
+        'POST',
+        '/123123/records/createMulti',
+        data=[
+            _rec('', 'A', '1.2.3.4', 300),
+            _rec('', 'A', '1.2.3.5', 300),
+            _rec('', 'ANAME', 'aname.unit.tests.', 1800),
+            _rec(
+                '',
+                'CAA',
+                'ca.unit.tests',
+                3600,
+                issuerCritical=0,
+                caaType='issue',
+            ),
+            _rec(
+                '_srv._tcp',
+                'SRV',
+                'foo-1.unit.tests.',
+                600,
+                port=30,
+                priority=10,
+                weight=20,
+            ),
+            _rec(
+                '_srv._tcp',
+                'SRV',
+                'foo-2.unit.tests.',
+                600,
+                port=30,
+                priority=12,
+                weight=20,
+            ),
+            _rec('aaaa', 'AAAA', '2601:644:500:e210:62f8:1dff:feb8:947a', 600),
+            _rec('cname', 'CNAME', 'unit.tests.', 300),
+            _rec('included', 'CNAME', 'unit.tests.', 3600),
+            _rec('mx', 'MX', 'smtp-4.unit.tests.', 300, mxLevel=10),
+            _rec('mx', 'MX', 'smtp-2.unit.tests.', 300, mxLevel=20),
+            _rec('mx', 'MX', 'smtp-3.unit.tests.', 300, mxLevel=30),
+            _rec('mx', 'MX', 'smtp-1.unit.tests.', 300, mxLevel=40),
+            _rec('ptr', 'PTR', 'foo.bar.com.', 300),
+            _rec('spf', 'SPF', '"v=spf1 ip4:192.168.0.1/16-all"', 600),
+            _rec(
+                'split',
+                'TXT',
+                '"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Nunc porttitor, odio eleifend ullamcorper ultricies, lectus lorem iaculis erat, ut porttitor erat orci eget est. Nunc tortor odio, suscipit non maximus in, euismod nec dolor. Nullam quis ultricies orci. Donec malesuada tempor accumsan. Vivamus erat eros, condimentum et urna vitae, aliquam congue quam. Phasellus nibh mauris, congue quis euismod vel, porta sed dui. Fusce massa dui, feugiat dapibus condimentum nec, vulputate eget ex. Sed vitae augue et ex facilisis placerat id sit amet tortor. Morbi pellentesque velit arcu, ut suscipit quam consectetur in. Quisque pulvinar ante sit amet egestas gravida. Etiam accumsan urna et suscipit pulvinar. Fusce ultricies congue sapien non semper. Morbi eleifend molestie blandit. Suspendisse potenti. Fusce vestibulum commodo leo. Nulla cursus turpis sit amet tincidunt bibendum."',
+                600,
+            ),
+            _rec('txt', 'TXT', '"Bah bah black sheep"', 600),
+            _rec('txt', 'TXT', '"have you any wool."', 600),
+            _rec(
+                'txt',
+                'TXT',
+                '"v=DKIM1;k=rsa;s=email;h=sha256;p=A/kinda+of/long/string+with+numb3rs"',
+                600,
+            ),
+            _rec('under', 'NS', 'ns1.unit.tests.', 3600),
+            _rec('under', 'NS', 'ns2.unit.tests.', 3600),
+            _rec('www', 'A', '2.2.3.6', 300),
+            _rec('www.sub', 'A', '2.2.3.6', 300),
+        ],
+    ),
+)
+
+
+def _call_sig(c):
+    # a hashable signature for a _request call, nested data/params are
+    # serialized rather than compared structurally
+    return (
+        c.args,
+        json.dumps(c.kwargs.get('data'), sort_keys=True),
+        json.dumps(c.kwargs.get('params'), sort_keys=True),
     )
 
-    for record in list(expected.records):
-        if record.name == 'sub' and record._type == 'NS':
-            expected._remove_record(record)
-            break
-
-    def test_populate(self):
-        provider = DnsMadeEasyProvider('test', 'api', 'secret')
-
-        # not found
-        with requests_mock() as mock:
-            mock.get(ANY, status_code=404, text='{"error": ["Not Found"]}')
 
-            with self.assertRaises(Exception) as ctx:
-                zone = Zone('unit.tests.', [])
-                provider.populate(zone)
-            self.assertEqual('Not Found', str(ctx.exception))
-
-        # Bad auth
-        with requests_mock() as mock:
-            mock.get(
-                ANY, status_code=401, text='{"error": ["API key not found"]}'
+class TestDnsMadeEasyProvider(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.expected = Zone('unit.tests.', [])
+        source = YamlProvider('test', join(dirname(__file__), 'config'))
+        source.populate(cls.expected)
+
+        # Our test suite differs a bit, add our NS and remove the simple one
+        cls.expected.add_record(
+            Record.new(
+                cls.expected,
+                'under',
+                {
+                    'ttl': 3600,
+                    'type': 'NS',
+                    'values': ['ns1.unit.tests.', 'ns2.unit.tests.'],
+                },
             )
+        )
 
-            with self.assertRaises(Exception) as ctx:
-                zone = Zone('unit.tests.', [])
-                provider.populate(zone)
-            self.assertEqual('Unauthorized', str(ctx.exception))
-
-        # Bad request
-        with requests_mock() as mock:
-            mock.get(
-                ANY, status_code=400, text='{"error": ["Rate limit exceeded"]}'
+        # Add some ALIAS records
+        cls.expected.add_record(
+            Record.new(
+                cls.expected,
+                '',
+                {'ttl': 1800, 'type': 'ALIAS', 'value': 'aname.unit.tests.'},
             )
+        )
 
-            with self.assertRaises(Exception) as ctx:
-                zone = Zone('unit.tests.', [])
-                provider.populate(zone)
-            self.assertEqual('\n  - Rate limit exceeded', str(ctx.exception))
-
-        # General error
-        with requests_mock() as mock:
-            mock.get(ANY, status_code=502, text='Things caught fire')
+        sub_ns = next(
+            r
+            for r in cls.expected.records
+            if r.name == 'sub' and r._type == 'NS'
+        )
+        cls.expected._remove_record(sub_ns)
+
+    def assertCallsMade(self, mock, expected):
+        made = {_call_sig(c) for c in mock.call_args_list}
+        missing = {_call_sig(c) for c in expected} - made
+        self.assertFalse(missing, 'expected calls not made')
+
+    def setUp(self):
+        # the common, default configured, provider. tests that need other
+        # options create their own
+        self.provider = DnsMadeEasyProvider('test', 'api', 'secret')
+
+    def mock_api(self, provider):
+        # mount a mock adapter directly on the client's session rather than
+        # patching requests' Session globally
+        adapter = Adapter()
+        provider._client._sess.mount('https://', adapter)
+        return adapter
+
+    def mock_client(self, provider):
+        # stub out the client's transport, tests set _json.side_effect to
+        # control the parsed responses
+        client = provider._client
+        client._request = Mock(return_value=Mock())
+        client._json = Mock()
+        return client
+
+    def test_populate_errors(self):
+        provider = self.provider
+
+        # a single adapter, each case's handler overrides the previous one
+        mock = self.mock_api(provider)
+
+        for status, body, exc_type, msg in (
+            (404, '{"error": ["Not Found"]}', Exception, 'Not Found'),
+            (
+                401,
+                '{"error": ["API key not found"]}',
+                Exception,
+                'Unauthorized',
+            ),
+            (
+                400,
+                '{"error": ["Rate limit exceeded"]}',
+                Exception,
+                '\n  - Rate limit exceeded',
+            ),
+            # unexpected body
+            (
+                400,
+                '{"message": "Nope"}',
+                Exception,
+                '\n  - {"message": "Nope"}',
+            ),
+            # a single error
+            (
+                400,
+                '{"error": "Rate limit exceeded"}',
+                Exception,
+                '\n  - Rate limit exceeded',
+            ),
+            # non-string errors
+            (400, '{"error": [1, 2]}', Exception, '\n  - 1\n  - 2'),
+            # json, but not an object
+            (400, 'null', Exception, '\n  - null'),
+            (400, '["Nope"]', Exception, '\n  - ["Nope"]'),
+            (400, '"oops"', Exception, '\n  - "oops"'),
+            # non-json body
+            (400, 'Bad Request', Exception, '\n  - Bad Request'),
+            # general error
+            (500, 'Things caught fire', HTTPError, None),
+        ):
+            with self.subTest(status=status, body=body):
+                mock.register_uri('GET', ANY, status_code=status, text=body)
+
+                with self.assertRaises(exc_type) as ctx:
+                    zone = Zone('unit.tests.', [])
+                    provider.populate(zone)
+                if msg is None:
+                    self.assertEqual(status, ctx.exception.response.status_code)
+                else:
+                    self.assertEqual(msg, str(ctx.exception))
 
-            with self.assertRaises(HTTPError) as ctx:
-                zone = Zone('unit.tests.', [])
-                provider.populate(zone)
-            self.assertEqual(502, ctx.exception.response.status_code)
+    def test_populate(self):
+        provider = self.provider
 
         # No diffs == no changes
-        with requests_mock() as mock:
-            base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
-            with open('tests/fixtures/dnsmadeeasy-domains.json') as fh:
-                mock.get(f'{base}/', text=fh.read())
-            with open('tests/fixtures/dnsmadeeasy-records.json') as fh:
-                mock.get(f'{base}/123123/records', text=fh.read())
+        mock = self.mock_api(provider)
+        base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
+        mock.register_uri(
+            'GET', f'{base}/', content=FIXTURE_BYTES['dnsmadeeasy-domains.json']
+        )
+        mock.register_uri(
+            'GET',
+            f'{base}/123123/records',
+            content=FIXTURE_BYTES['dnsmadeeasy-records.json'],
+        )
 
-                zone = Zone('unit.tests.', [])
-                provider.populate(zone)
-                self.assertEqual(15, len(zone.records))
-                changes = self.expected.changes(zone, provider)
-                self.assertEqual(0, len(changes))
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        self.assertEqual(15, len(zone.records))
+        changes = self.expected.changes(zone, provider)
+        self.assertEqual(0, len(changes))
+
+    def test_populate_uses_cache(self):
+        provider = self.provider
+        self.mock_client(provider)
+
+        # parsed fresh here since records() rewrites them in place
+        provider._client._json.side_effect = (
+            json.loads(FIXTURE_BYTES['dnsmadeeasy-domains.json']),
+            json.loads(FIXTURE_BYTES['dnsmadeeasy-records.json']),
+        )
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        self.assertEqual(15, len(zone.records))
 
         # 2nd populate makes no network calls/all from cache
+        provider._client._request = Mock(side_effect=AssertionError)
         again = Zone('unit.tests.', [])
         provider.populate(again)
         self.assertEqual(15, len(again.records))
+        self.assertFalse(provider._client._request.called)
+
+    def test_populate_paginated(self):
+        records = FIXTURE_JSON['dnsmadeeasy-records.json']
+        # split the records across 3 pages
+        data = records['data']
+        pages = [data[:10], data[10:20], data[20:]]
+
+        # pages are fetched one after another by default, concurrently when
+        # opted in to
+        for concurrent_batches in (1, 2):
+            with self.subTest(concurrent_batches=concurrent_batches):
+                provider = DnsMadeEasyProvider(
+                    'test',
+                    'api',
+                    'secret',
+                    concurrent_batches=concurrent_batches,
+                )
+                mock = self.mock_api(provider)
+                base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
+                mock.register_uri(
+                    'GET',
+                    f'{base}/',
+                    content=FIXTURE_BYTES['dnsmadeeasy-domains.json'],
+                )
+                for i, page in enumerate(pages):
+                    mock.register_uri(
+                        'GET',
+                        f'{base}/123123/records?rows=500&page={i}',
+                        json={
+                            'totalPages': len(pages),
+                            'totalRecords': len(data),
+                            'page': i,
+                            'data': page,
+                        },
+                    )
 
-        # bust the cache
-        del provider._zone_records[zone.name]
+                zone = Zone('unit.tests.', [])
+                provider.populate(zone)
+                self.assertEqual(15, len(zone.records))
+                changes = self.expected.changes(zone, provider)
+                self.assertEqual(0, len(changes))
+                # 1 domains request and 3 records pages
+                self.assertEqual(4, mock.call_count)
 
     def test_populate_empty(self):
-        provider = DnsMadeEasyProvider('test', 'api', 'secret')
+        provider = self.provider
 
         # Non-existent zone doesn't populate anything
-        with requests_mock() as mock:
-            with open('tests/fixtures/dnsmadeeasy-no-domains.json') as fh:
-                mock.get(ANY, text=fh.read())
+        mock = self.mock_api(provider)
+        mock.register_uri(
+            'GET', ANY, content=FIXTURE_BYTES['dnsmadeeasy-no-domains.json']
+        )
 
-            zone = Zone('unit.tests.', [])
-            provider.populate(zone)
-            self.assertEqual(set(), zone.records)
+        zone = Zone('unit.tests.', [])
+        provider.populate(zone)
+        self.assertEqual(set(), zone.records)
 
-    def test_apply(self):
+    def test_apply_creates_new_domain(self):
         # Create provider with sandbox enabled
         provider = DnsMadeEasyProvider(
             'test', 'api', 'secret', True, strict_supports=False
         )
 
-        resp = Mock()
-        resp.json = Mock()
-        provider._client._request = Mock(return_value=resp)
-
-        with open('tests/fixtures/dnsmadeeasy-no-domains.json') as fh:
-            no_domains = json.load(fh)
-
-        with open('tests/fixtures/dnsmadeeasy-domains.json') as fh:
-            domains = json.load(fh)
-
-        with open('tests/fixtures/dnsmadeeasy-domain-create.json') as fh:
-            created_domain = json.load(fh)
+        self.mock_client(provider)
 
         # non-existent domain, create everything
-        resp.json.side_effect = [
-            no_domains,  # no zone in populate
-            DnsMadeEasyClientNotFound,  # no domain during apply
-            created_domain,  # our created domain response
-            domains,
-        ]
+        provider._client._json.side_effect = CREATE_RESPONSES
         plan = provider.plan(self.expected)
 
         # No ignored, no excluded, no unsupported
@@ -161,243 +440,31 @@ class TestDnsMadeEasyProvider(TestCase):
         self.assertEqual(n, len(plan.changes))
         self.assertEqual(n, provider.apply(plan))
 
-        provider._client._request.assert_has_calls(
-            [
-                # get all domains to build the cache
-                call('GET', '/'),
-                # attempt to find the domain based on the name
-                call('GET', '/id/unit.tests'),
-                # create the domain
-                call('POST', '/', data={'name': 'unit.tests'}),
-                # created all the non-existent records in a single request
-                call(
-                    'POST',
-                    '/123123/records/createMulti',
-                    data=[
-                        {
-                            'value': '1.2.3.4',
-                            'name': '',
-                            'ttl': 300,
-                            'type': 'A',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '1.2.3.5',
-                            'name': '',
-                            'ttl': 300,
-                            'type': 'A',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'aname.unit.tests.',
-                            'name': '',
-                            'ttl': 1800,
-                            'type': 'ANAME',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'ca.unit.tests',
-                            'issuerCritical': 0,
-                            'name': '',
-                            'caaType': 'issue',
-                            'ttl': 3600,
-                            'type': 'CAA',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'foo-1.unit.tests.',
-                            'name': '_srv._tcp',
-                            'port': 30,
-                            'priority': 10,
-                            'ttl': 600,
-                            'type': 'SRV',
-                            'weight': 20,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'foo-2.unit.tests.',
-                            'name': '_srv._tcp',
-                            'port': 30,
-                            'priority': 12,
-                            'ttl': 600,
-                            'type': 'SRV',
-                            'weight': 20,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '2601:644:500:e210:62f8:1dff:feb8:947a',
-                            'name': 'aaaa',
-                            'ttl': 600,
-                            'type': 'AAAA',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'unit.tests.',
-                            'name': 'cname',
-                            'ttl': 300,
-                            'type': 'CNAME',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'unit.tests.',
-                            'name': 'included',
-                            'ttl': 3600,
-                            'type': 'CNAME',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'smtp-4.unit.tests.',
-                            'name': 'mx',
-                            'mxLevel': 10,
-                            'ttl': 300,
-                            'type': 'MX',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'smtp-2.unit.tests.',
-                            'name': 'mx',
-                            'mxLevel': 20,
-                            'ttl': 300,
-                            'type': 'MX',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'smtp-3.unit.tests.',
-                            'name': 'mx',
-                            'mxLevel': 30,
-                            'ttl': 300,
-                            'type': 'MX',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'smtp-1.unit.tests.',
-                            'name': 'mx',
-                            'mxLevel': 40,
-                            'ttl': 300,
-                            'type': 'MX',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'foo.bar.com.',
-                            'name': 'ptr',
-                            'ttl': 300,
-                            'type': 'PTR',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '"v=spf1 ip4:192.168.0.1/16-all"',
-                            'name': 'spf',
-                            'ttl': 600,
-                            'type': 'SPF',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Nunc porttitor, odio eleifend ullamcorper ultricies, lectus lorem iaculis erat, ut porttitor erat orci eget est. Nunc tortor odio, suscipit non maximus in, euismod nec dolor. Nullam quis ultricies orci. Donec malesuada tempor accumsan. Vivamus erat eros, condimentum et urna vitae, aliquam congue quam. Phasellus nibh mauris, congue quis euismod vel, porta sed dui. Fusce massa dui, feugiat dapibus condimentum nec, vulputate eget ex. Sed vitae augue et ex facilisis placerat id sit amet tortor. Morbi pellentesque velit arcu, ut suscipit quam consectetur in. Quisque pulvinar ante sit amet egestas gravida. Etiam accumsan urna et suscipit pulvinar. Fusce ultricies congue sapien non semper. Morbi eleifend molestie blandit. Suspendisse potenti. Fusce vestibulum commodo leo. Nulla cursus turpis sit amet tincidunt bibendum."',
-                            'name': 'split',
-                            'ttl': 600,
-                            'type': 'TXT',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '"Bah bah black sheep"',
-                            'name': 'txt',
-                            'ttl': 600,
-                            'type': 'TXT',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '"have you any wool."',
-                            'name': 'txt',
-                            'ttl': 600,
-                            'type': 'TXT',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '"v=DKIM1;k=rsa;s=email;h=sha256;p=A/kinda+of/long/string+with+numb3rs"',
-                            'name': 'txt',
-                            'ttl': 600,
-                            'type': 'TXT',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'ns1.unit.tests.',
-                            'name': 'under',
-                            'ttl': 3600,
-                            'type': 'NS',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': 'ns2.unit.tests.',
-                            'name': 'under',
-                            'ttl': 3600,
-                            'type': 'NS',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '2.2.3.6',
-                            'name': 'www',
-                            'ttl': 300,
-                            'type': 'A',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '2.2.3.6',
-                            'name': 'www.sub',
-                            'ttl': 300,
-                            'type': 'A',
-                            'gtdLocation': 'DEFAULT',
-                        },
-                    ],
-                ),
-            ]
-        )
+        provider._client._request.assert_has_calls(list(EXPECTED_CREATE_CALLS))
         self.assertEqual(4, provider._client._request.call_count)
 
-        provider._client._request.reset_mock()
+    def test_apply_updates_and_deletes_existing(self):
+        provider = DnsMadeEasyProvider(
+            'test', 'api', 'secret', True, strict_supports=False
+        )
+
+        self.mock_client(provider)
+        # the domain is already known to the client, no need to list them
+        provider._client._domains = {'unit.tests.': 123123}
 
         # delete 1 and update 1
-        provider._client.records = Mock(
-            return_value=[
-                {
-                    'id': 11189897,
-                    'name': 'www',
-                    'value': '1.2.3.4',
-                    'ttl': 300,
-                    'type': 'A',
-                },
-                {
-                    'id': 11189898,
-                    'name': 'www',
-                    'value': '2.2.3.4',
-                    'ttl': 300,
-                    'type': 'A',
-                },
-                {
-                    'id': 11189899,
-                    'name': 'ttl',
-                    'value': '3.2.3.4',
-                    'ttl': 600,
-                    'type': 'A',
-                },
-            ]
-        )
+        provider._client.records = Mock(return_value=ACCOUNT_RECORDS)
 
         # Domain exists, we don't care about return
-        resp.json.side_effect = ['{}']
+        provider._client._json.side_effect = ('{}',)
 
-        wanted = Zone('unit.tests.', [])
-        wanted.add_record(
-            Record.new(
-                wanted, 'ttl', {'ttl': 300, 'type': 'A', 'value': '3.2.3.4'}
-            )
-        )
-
-        plan = provider.plan(wanted)
+        plan = provider.plan(ttl_zone())
         self.assertEqual(2, len(plan.changes))
         self.assertEqual(2, provider.apply(plan))
 
         # recreate for update, and deletes for the 2 parts of the other
-        provider._client._request.assert_has_calls(
+        self.assertCallsMade(
+            provider._client._request,
             [
                 call(
                     'POST',
@@ -418,27 +485,16 @@ class TestDnsMadeEasyProvider(TestCase):
                     params={'ids': [11189897, 11189898, 11189899]},
                 ),
             ],
-            any_order=True,
         )
         self.assertEqual(3, provider._client._request.call_count)
 
         # test for just deleting a record, no additions
 
-        provider._client._request.reset_mock()
-        provider._client.records = Mock(
-            return_value=[
-                {
-                    'id': 11189897,
-                    'name': 'www',
-                    'value': '1.2.3.4',
-                    'ttl': 300,
-                    'type': 'A',
-                }
-            ]
-        )
+        provider._client._request = Mock(return_value=Mock())
+        provider._client.records = Mock(return_value=ACCOUNT_RECORDS[:1])
 
         # Domain exists, we don't care about return
-        resp.json.side_effect = ['{}']
+        provider._client._json.side_effect = ('{}',)
 
         wanted = Zone('unit.tests.', [])
 
@@ -447,9 +503,9 @@ class TestDnsMadeEasyProvider(TestCase):
         self.assertEqual(1, provider.apply(plan))
 
         # recreate for update, and deletes for the 2 parts of the other
-        provider._client._request.assert_has_calls(
+        self.assertCallsMade(
+            provider._client._request,
             [call('DELETE', '/123123/records', params={'ids': [11189897]})],
-            any_order=True,
         )
         self.assertEqual(2, provider._client._request.call_count)
 
@@ -459,67 +515,29 @@ class TestDnsMadeEasyProvider(TestCase):
             'test', 'api', 'secret', True, batch_size=2, strict_supports=False
         )
 
-        resp = Mock()
-        resp.json = Mock()
-        provider._client._request = Mock(return_value=resp)
+        self.mock_client(provider)
 
-        provider._client.records = Mock(
-            return_value=[
-                {
-                    'id': 11189897,
-                    'name': 'www',
-                    'value': '1.2.3.4',
-                    'ttl': 300,
-                    'type': 'A',
-                },
-                {
-                    'id': 11189898,
-                    'name': 'www',
-                    'value': '2.2.3.4',
-                    'ttl': 300,
-                    'type': 'A',
-                },
-                {
-                    'id': 11189899,
-                    'name': 'ttl',
-                    'value': '3.2.3.4',
-                    'ttl': 600,
-                    'type': 'A',
-                },
-            ]
-        )
+        provider._client.records = Mock(return_value=ACCOUNT_RECORDS)
 
         # Domain exists, we don't care about return
 
-        with open('tests/fixtures/dnsmadeeasy-domains.json') as fh:
-            domains = json.load(fh)
-
-        with open('tests/fixtures/dnsmadeeasy-domain-create.json') as fh:
-            created_domain = json.load(fh)
+        domains = FIXTURE_JSON['dnsmadeeasy-domains.json']
+        created_domain = FIXTURE_JSON['dnsmadeeasy-domain-create.json']
 
         # non-existent domain, create everything
-        resp.json.side_effect = [
+        provider._client._json.side_effect = (
             created_domain,  # GET /id/unit.tests during plan
             domains,  # domains during plan
             domains,  # domains during apply
-        ]
-
-        wanted = Zone('unit.tests.', [])
-        for i in range(1, 10):
-            wanted.add_record(
-                Record.new(
-                    wanted,
-                    f'www{i}',
-                    {'ttl': 300, 'type': 'A', 'value': f'3.2.3.{i}'},
-                )
-            )
+        )
 
-        plan = provider.plan(wanted)
+        plan = provider.plan(www_zone())
         self.assertEqual(11, len(plan.changes))
         self.assertEqual(11, provider.apply(plan))
 
         # recreate for update, and deletes for the 2 parts of the other
-        provider._client._request.assert_has_calls(
+        self.assertCallsMade(
+            provider._client._request,
             [
                 call(
                     'DELETE',
@@ -527,121 +545,381 @@ class TestDnsMadeEasyProvider(TestCase):
                     params={'ids': [11189899, 11189897]},
                 ),
                 call('DELETE', '/123123/records', params={'ids': [11189898]}),
+            ]
+            + [
                 call(
                     'POST',
                     '/123123/records/createMulti',
                     data=[
-                        {
-                            'value': '3.2.3.1',
-                            'type': 'A',
-                            'name': 'www1',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '3.2.3.2',
-                            'type': 'A',
-                            'name': 'www2',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                    ],
-                ),
-                call(
-                    'POST',
-                    '/123123/records/createMulti',
-                    data=[
-                        {
-                            'value': '3.2.3.3',
-                            'type': 'A',
-                            'name': 'www3',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '3.2.3.4',
-                            'type': 'A',
-                            'name': 'www4',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                    ],
-                ),
-                call(
-                    'POST',
-                    '/123123/records/createMulti',
-                    data=[
-                        {
-                            'value': '3.2.3.5',
-                            'type': 'A',
-                            'name': 'www5',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '3.2.3.6',
-                            'type': 'A',
-                            'name': 'www6',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                    ],
-                ),
-                call(
-                    'POST',
-                    '/123123/records/createMulti',
-                    data=[
-                        {
-                            'value': '3.2.3.7',
-                            'type': 'A',
-                            'name': 'www7',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                        {
-                            'value': '3.2.3.8',
-                            'type': 'A',
-                            'name': 'www8',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        },
-                    ],
-                ),
-                call(
-                    'POST',
-                    '/123123/records/createMulti',
-                    data=[
-                        {
-                            'value': '3.2.3.9',
-                            'type': 'A',
-                            'name': 'www9',
-                            'ttl': 300,
-                            'gtdLocation': 'DEFAULT',
-                        }
+                        _rec(f'www{i}', 'A', f'3.2.3.{i}', 300)
+                        for i in range(start, min(start + 2, 10))
                     ],
-                ),
+                )
+                # batches of 2 for www1-9
+                for start in range(1, 10, 2)
             ],
-            any_order=True,
         )
         self.assertEqual(9, provider._client._request.call_count)
 
+    @patch('octodns_dnsmadeeasy.sleep')
+    def test_ratelimit_delay(self, sleep_mock):
+        base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
+
+        # no delay, no sleep
+        provider = self.provider
+        mock = self.mock_api(provider)
+        mock.register_uri('GET', f'{base}/', text='{"data": []}')
+        provider._client._request('GET', '/')
+        sleep_mock.assert_not_called()
+
+        # delay configured, sleep after the request
+        provider = DnsMadeEasyProvider(
+            'test', 'api', 'secret', ratelimit_delay=0.5
+        )
+        mock = self.mock_api(provider)
+        mock.register_uri('GET', f'{base}/', text='{"data": []}')
+        provider._client._request('GET', '/')
+        sleep_mock.assert_called_once_with(0.5)
+
+    def test_request_body(self):
+        provider = self.provider
+        client = provider._client
+        client._domains = {}
+
+        base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
+        mock = self.mock_api(provider)
+        mock.register_uri(
+            'POST', f'{base}/', text='{"id": 42, "name": "unit.tests"}'
+        )
+        client.domain_create('unit.tests')
+
+        request = mock.last_request
+        self.assertEqual('application/json', request.headers['Content-Type'])
+        self.assertEqual({'name': 'unit.tests'}, request.json())
+        self.assertEqual({'unit.tests.': 42}, client.domains)
+
+    def test_json_fallback(self):
+        # load a separate copy of the module with orjson unavailable
+        spec = spec_from_file_location(
+            'octodns_dnsmadeeasy_no_orjson', octodns_dnsmadeeasy.__file__
+        )
+        module = module_from_spec(spec)
+        with patch.dict('sys.modules', {'orjson': None}):
+            spec.loader.exec_module(module)
+        self.assertIs(json, module.jsonlib)
+
+    @skipUnless(orjson, 'orjson not installed')
+    @patch('octodns_dnsmadeeasy.jsonlib', orjson)
+    def test_request_body_orjson(self):
+        provider = self.provider
+        client = provider._client
+        client._domains = {}
+
+        base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
+        mock = self.mock_api(provider)
+        mock.register_uri(
+            'POST', f'{base}/', text='{"id": 42, "name": "unit.tests"}'
+        )
+        client.domain_create('unit.tests')
+
+        request = mock.last_request
+        self.assertIsInstance(request.body, bytes)
+        self.assertEqual('application/json', request.headers['Content-Type'])
+        self.assertEqual({'name': 'unit.tests'}, request.json())
+        self.assertEqual({'unit.tests.': 42}, client.domains)
+
+        # octodns' values are str subclasses, they're serialized as plain
+        # strings
+        zone = Zone('unit.tests.', [])
+        records = [
+            Record.new(
+                zone, 'a', {'ttl': 300, 'type': 'A', 'value': '1.2.3.4'}
+            ),
+            Record.new(
+                zone, 'aaaa', {'ttl': 300, 'type': 'AAAA', 'value': '::1'}
+            ),
+            Record.new(
+                zone,
+                'cname',
+                {'ttl': 300, 'type': 'CNAME', 'value': 'target.unit.tests.'},
+            ),
+            Record.new(
+                zone,
+                'mx',
+                {
+                    'ttl': 300,
+                    'type': 'MX',
+                    'value': {'preference': 10, 'exchange': 'mx.unit.tests.'},
+                },
+            ),
+        ]
+        creations = []
+        for record in records:
+            creations.extend(provider._params_for[record._type](record))
+        mock.register_uri(
+            'POST', f'{base}/42/records/createMulti', status_code=201
+        )
+        client.record_multi_create('unit.tests.', creations)
+
+        request = mock.last_request
+        self.assertIsInstance(request.body, bytes)
+        self.assertEqual(
+            [
+                _rec('a', 'A', '1.2.3.4', 300),
+                _rec('aaaa', 'AAAA', '::1', 300),
+                _rec('cname', 'CNAME', 'target.unit.tests.', 300),
+                _rec('mx', 'MX', 'mx.unit.tests.', 300, mxLevel=10),
+            ],
+            request.json(),
+        )
+
+        # errors are parsed the same, invalid json falls back to the body
+        for body, msg in (
+            ('{"error": ["Nope"]}', '\n  - Nope'),
+            ('Bad Request', '\n  - Bad Request'),
+        ):
+            with self.subTest(body=body):
+                mock.register_uri('GET', ANY, status_code=400, text=body)
+                with self.assertRaises(DnsMadeEasyClientBadRequest) as ctx:
+                    client._request('GET', '/')
+                self.assertEqual(msg, str(ctx.exception))
+
+    def test_session_retries(self):
+        provider = self.provider
+        adapter = provider._client._sess.get_adapter(
+            'https://api.dnsmadeeasy.com/'
+        )
+        # only connection failures are retried by urllib3, briefly
+        retry = adapter.max_retries
+        self.assertEqual(3, retry.total)
+        self.assertFalse(retry.status_forcelist)
+        self.assertNotIn('POST', retry.allowed_methods)
+        # statuses, with or without Retry-After, are left to _request
+        for method in ('GET', 'DELETE', 'POST'):
+            for status in (429, 502, 503, 504):
+                for has_retry_after in (False, True):
+                    self.assertFalse(
+                        retry.is_retry(
+                            method, status, has_retry_after=has_retry_after
+                        )
+                    )
+
+        # the pool is sized to the number of concurrent requests
+        self.assertEqual(1, adapter._pool_maxsize)
+        provider = DnsMadeEasyProvider(
+            'test', 'api', 'secret', concurrent_batches=32
+        )
+        adapter = provider._client._sess.get_adapter(
+            'https://api.dnsmadeeasy.com/'
+        )
+        self.assertEqual(32, adapter._pool_maxsize)
+
+    @patch('octodns_dnsmadeeasy.sleep')
+    @patch('octodns_dnsmadeeasy.time')
+    def test_request_retries(self, time_mock, sleep_mock):
+        # every attempt happens 10s after the previous one
+        time_mock.side_effect = range(1672628645, 1672629645, 10)
+        client = self.provider._client
+        base = 'https://api.dnsmadeeasy.com/V2.0/dns/managed'
+        mock = self.mock_api(self.provider)
+        mock.register_uri(
+            'GET',
+            f'{base}/',
+            [
+                # dates aren't supported, falls back to backoff
+                {
+                    'status_code': 503,
+                    'headers': {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'},
+                },
+                {'status_code': 429, 'headers': {'Retry-After': '7'}},
+                {'status_code': 200, 'text': '{"data": []}'},
+            ],
+        )
+
+        resp = client._request('GET', '/')
+        self.assertEqual(200, resp.status_code)
+        # backoff, then Retry-After
+        sleep_mock.assert_has_calls([call(0.25), call(7.0)])
+        # each attempt was signed with its own, current, date
+        dates = [r.headers['x-dnsme-requestDate'] for r in mock.request_history]
+        self.assertEqual(3, len(set(dates)))
+        for r in mock.request_history:
+            self.assertEqual(
+                client._hmac_hash(r.headers['x-dnsme-requestDate']),
+                r.headers['x-dnsme-hmac'],
+            )
+
+        # gives up after the configured number of retries
+        sleep_mock.reset_mock()
+        mock = self.mock_api(self.provider)
+        mock.register_uri('GET', f'{base}/', status_code=502)
+        with self.assertRaises(HTTPError):
+            client._request('GET', '/')
+        self.assertEqual(client.RETRIES + 1, mock.call_count)
+        sleep_mock.assert_has_calls(
+            [call(0.25), call(0.5), call(1.0), call(2.0), call(4.0)]
+        )
+
+        # POSTs aren't retried on errors that may have been applied
+        mock = self.mock_api(self.provider)
+        mock.register_uri('POST', f'{base}/', status_code=503)
+        with self.assertRaises(HTTPError):
+            client._request('POST', '/', data={'name': 'unit.tests'})
+        self.assertEqual(1, mock.call_count)
+
+        # but are when rate limited
+        sleep_mock.reset_mock()
+        mock = self.mock_api(self.provider)
+        mock.register_uri(
+            'POST',
+            f'{base}/records/createMulti',
+            [
+                {'status_code': 429, 'headers': {'Retry-After': '2'}},
+                {'status_code': 201, 'text': '[]'},
+            ],
+        )
+        resp = client._request('POST', '/records/createMulti', data=[])
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual(2, mock.call_count)
+        sleep_mock.assert_called_once_with(2.0)
+        # with the same body both times
+        self.assertEqual(
+            mock.request_history[0].body, mock.request_history[1].body
+        )
+
+    def test_retry_wait(self):
+        client = self.provider._client
+        for headers, attempt, expected in (
+            # no Retry-After, exponential backoff
+            ({}, 1, 0.25),
+            ({}, 3, 1.0),
+            # seconds are honored
+            ({'Retry-After': '7'}, 1, 7.0),
+            ({'Retry-After': '0'}, 1, 0),
+            # within reason
+            ({'Retry-After': '-3'}, 1, 0),
+            ({'Retry-After': '3600'}, 1, client.RETRY_AFTER_MAX),
+            # non-finite & unsupported values fall back to backoff
+            ({'Retry-After': 'nan'}, 2, 0.5),
+            ({'Retry-After': 'inf'}, 2, 0.5),
+            ({'Retry-After': '-inf'}, 2, 0.5),
+            ({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 2, 0.5),
+        ):
+            with self.subTest(headers=headers, attempt=attempt):
+                resp = Mock(headers=headers)
+                self.assertEqual(expected, client._retry_wait(resp, attempt))
+
+    def test_hmac_hash(self):
+        provider = self.provider
+        client = provider._client
+
+        now = 'Mon, 02 Jan 2023 03:04:05 +0000'
+        expected = hmac.new(b'secret', now.encode(), hashlib.sha1).hexdigest()
+        self.assertEqual(expected, client._hmac_hash(now))
+        # repeated calls don't accumulate state
+        self.assertEqual(expected, client._hmac_hash(now))
+
+    @patch('octodns_dnsmadeeasy.time')
+    def test_current_time(self, time_mock):
+        provider = self.provider
+        client = provider._client
+
+        time_mock.return_value = 1672628645.1
+        self.assertEqual(
+            'Mon, 02 Jan 2023 03:04:05 +0000', client._current_time()
+        )
+        # same second, cached value
+        time_mock.return_value = 1672628645.9
+        self.assertEqual(
+            'Mon, 02 Jan 2023 03:04:05 +0000', client._current_time()
+        )
+        # next second
+        time_mock.return_value = 1672628646.0
+        self.assertEqual(
+            'Mon, 02 Jan 2023 03:04:06 +0000', client._current_time()
+        )
+
+    def test_delete_batch_size(self):
+        provider = DnsMadeEasyProvider(
+            'test', 'api', 'secret', batch_size=2, delete_batch_size=3
+        )
+        client = provider._client
+        client._domains = {'unit.tests.': 123123}
+        client._request = Mock()
+
+        client.record_multi_delete('unit.tests.', [1, 2, 3, 4, 5])
+        client._request.assert_has_calls(
+            [
+                call('DELETE', '/123123/records', params={'ids': [1, 2, 3]}),
+                call('DELETE', '/123123/records', params={'ids': [4, 5]}),
+            ]
+        )
+        self.assertEqual(2, client._request.call_count)
+
+        # defaults to batch_size
+        provider = DnsMadeEasyProvider('test', 'api', 'secret', batch_size=2)
+        self.assertEqual(2, provider._client.delete_batch_size)
+
+    def test_concurrent_batches(self):
+        provider = DnsMadeEasyProvider(
+            'test', 'api', 'secret', batch_size=2, concurrent_batches=2
+        )
+        client = provider._client
+        client._domains = {'unit.tests.': 123123}
+        client._request = Mock()
+
+        client.record_multi_delete('unit.tests.', [1, 2, 3])
+        self.assertCallsMade(
+            client._request,
+            [
+                call('DELETE', '/123123/records', params={'ids': [1, 2]}),
+                call('DELETE', '/123123/records', params={'ids': [3]}),
+            ],
+        )
+        self.assertEqual(2, client._request.call_count)
+
+        client._request = Mock()
+        records = [
+            {'name': f'www{i}', 'type': 'A', 'value': f'1.2.3.{i}', 'ttl': 300}
+            for i in range(3)
+        ]
+        client.record_multi_create('unit.tests.', records)
+        self.assertCallsMade(
+            client._request,
+            [
+                call('POST', '/123123/records/createMulti', data=records[:2]),
+                call('POST', '/123123/records/createMulti', data=records[2:]),
+            ],
+        )
+        self.assertEqual(2, client._request.call_count)
+
+        # errors in a batch are raised
+        client._request = Mock()
+        client._request.side_effect = DnsMadeEasyClientNotFound()
+        with self.assertRaises(DnsMadeEasyClientNotFound):
+            client.record_multi_delete('unit.tests.', [1, 2, 3])
+
     def test_quotes_in_TXT(self):
-        provider = DnsMadeEasyProvider('test', 'api', 'secret')
-        desired = Zone('unit.tests.', [])
+        provider = self.provider
         value = 'This has "quote" chars in it'
-        txt = Record.new(
-            desired, 'txt', {'ttl': 42, 'type': 'TXT', 'value': value}
-        )
-        desired.add_record(txt)
+
+        def desired_zone():
+            desired = Zone('unit.tests.', [])
+            desired.add_record(
+                Record.new(
+                    desired, 'txt', {'ttl': 42, 'type': 'TXT', 'value': value}
+                )
+            )
+            return desired
 
         with self.assertRaises(SupportsException) as ctx:
-            provider._process_desired_zone(desired)
+            provider._process_desired_zone(desired_zone())
         self.assertEqual(
             'test: Quotes not supported in TXT values', str(ctx.exception)
         )
 
         provider.strict_supports = False
-        got = provider._process_desired_zone(desired.copy())
+        got = provider._process_desired_zone(desired_zone())
         self.assertEqual(
             [value.replace('"', '')], next(iter(got.records)).values
         )